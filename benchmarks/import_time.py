@@ -0,0 +1,60 @@
+"""Measures how long it takes to import livescrape.
+
+Every sample runs in a fresh interpreter, so nothing is cached in
+sys.modules. Usage:
+
+    python benchmarks/import_time.py [--samples N] [--max-ms MS]
+
+With --max-ms, the script exits with a non-zero status when the median
+import time exceeds the limit, so it can be used to guard against
+regressions in CI.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPET = """
+import sys, time
+start = time.time()
+import livescrape
+elapsed = time.time() - start
+heavy = [m for m in ('requests', 'lxml') if m in sys.modules]
+print('%f %s' % (elapsed, ','.join(heavy)))
+"""
+
+
+def measure():
+    output = subprocess.check_output([sys.executable, "-c", SNIPPET],
+                                     cwd=ROOT)
+    elapsed, _, heavy = output.decode("ascii").strip().partition(" ")
+    return float(elapsed) * 1000, heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--max-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.samples)]
+    timings = sorted(elapsed for (elapsed, _) in results)
+    median = timings[len(timings) // 2]
+
+    print("import livescrape: median %.1fms, min %.1fms, max %.1fms "
+          "(%d samples)" % (median, timings[0], timings[-1], args.samples))
+
+    heavy = results[0][1]
+    if heavy:
+        print("eagerly imported: %s" % heavy)
+
+    if args.max_ms is not None and median > args.max_ms:
+        print("FAIL: median exceeds %.1fms" % args.max_ms)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
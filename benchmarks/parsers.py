@@ -0,0 +1,145 @@
+"""Compares the parser backends on a set of fixture pages.
+
+For every backend, this measures parsing only, and parsing followed by
+scraping a listing page with a typical set of attributes. Backends whose
+library is not installed are skipped. Usage:
+
+    python benchmarks/parsers.py [--repeat N] [page.html ...]
+
+Any html files passed on the command line are parsed (but not scraped)
+in addition to the built-in fixtures.
+"""
+import argparse
+import io
+import os
+import sys
+import timeit
+
+import six
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import livescrape  # noqa
+
+LISTING_ROW = """
+<tr class="row" data-id="%(id)d">
+  <!-- row %(id)d -->
+  <td class="name"><a href="/item/%(id)d">Item %(id)d</a></td>
+  <td class="price">%(id)d.95</td>
+  <td class="date">2016-04-%(day)02d</td>
+  <td class="description">Some <b>bold</b> and <i>italic</i> text</td>
+</tr>"""
+
+LISTING = """<!DOCTYPE html>
+<html><head><title>Listing</title>
+<script>var analytics = {"id": 1234};</script>
+</head><body>
+<h1 class="title">Listing</h1>
+<table class="items">%s</table>
+<a class="next" href="/page/2">Next</a>
+</body></html>""" % "".join(LISTING_ROW % {"id": i, "day": i % 28 + 1}
+                            for i in range(500))
+
+BROKEN = """<html><body>
+<h1 class="title">Broken<p>Unclosed <b>tags <i>everywhere</b>
+<table class="items"><tr class="row"><td class="name"><a href="/1">One
+<tr class="row"><td class="name"><a href=/2>Two</td></table>
+<div><span>dangling""" * 100
+
+FIXTURES = [("listing", LISTING), ("broken", BROKEN)]
+
+
+class LegacyLxmlBackend(livescrape.LxmlBackend):
+    """The parsing strategy from before backends were introduced."""
+
+    def parse(self, page):
+        import lxml.html
+
+        return lxml.html.fromstring(page)
+
+    def select(self, element, selector):
+        return element.cssselect(selector)
+
+
+BACKENDS = [
+    ("lxml (fromstring)", LegacyLxmlBackend, {}),
+    ("lxml", livescrape.LxmlBackend, {}),
+    ("lxml (stripped)", livescrape.LxmlBackend,
+     {"remove_comments": True, "remove_scripts": True}),
+    ("html5lib", livescrape.Html5libBackend, {}),
+    ("selectolax", livescrape.SelectolaxBackend, {}),
+    ("selectolax (stripped)", livescrape.SelectolaxBackend,
+     {"remove_comments": True, "remove_scripts": True}),
+]
+
+
+def make_page_class(backend, html):
+    class ListingPage(livescrape.ScrapedPage):
+        scrape_url = "http://localhost/"
+        scrape_parser = backend
+
+        title = livescrape.Css("h1.title")
+        next = livescrape.CssLink("a.next", "ListingPage")
+        items = livescrape.CssGroup("tr.row", multiple=True)
+        items.name = livescrape.Css("td.name")
+        items.link = livescrape.Css("td.name a", attribute="href")
+        items.price = livescrape.CssFloat("td.price")
+        items.date = livescrape.CssDate("td.date", "%Y-%m-%d")
+        items.description = livescrape.CssRaw("td.description")
+
+        def scrape_fetch(self, url):
+            return html
+
+    return ListingPage
+
+
+def scrape(page_class):
+    page = page_class()
+    return [item._dict() for item in page.items]
+
+
+def available(backend):
+    try:
+        backend.parse(six.text_type("<p>test</p>"))
+    except ImportError:
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("pages", nargs="*")
+    args = parser.parse_args()
+
+    fixtures = list(FIXTURES)
+    for filename in args.pages:
+        with io.open(filename, encoding="utf8") as f:
+            fixtures.append((filename, f.read()))
+
+    print("%-24s %-16s %10s %10s" % ("backend", "fixture", "parse",
+                                     "scrape"))
+    for (name, factory, options) in BACKENDS:
+        backend = factory(**options)
+        if not available(backend):
+            print("%-24s (not installed)" % name)
+            continue
+
+        for (fixture, html) in fixtures:
+            html = six.text_type(html)
+            parse_time = min(timeit.repeat(lambda: backend.parse(html),
+                                           number=1, repeat=args.repeat))
+            scrape_time = ""
+            if fixture == "listing":
+                page_class = make_page_class(backend, html)
+                scrape_time = "%8.2fms" % (1000 * min(timeit.repeat(
+                    lambda: scrape(page_class), number=1,
+                    repeat=args.repeat)))
+
+            print("%-24s %-16s %8.2fms %10s" % (name, fixture,
+                                                1000 * parse_time,
+                                                scrape_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
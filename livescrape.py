@@ -1,20 +1,264 @@
 from abc import abstractmethod
-import cgi
+import csv
 import datetime
+import itertools
+import json
+import sys
+import threading
 try:
     import urlparse  # python2
 except ImportError:  # pragma: no cover
     import urllib.parse as urlparse
 import warnings
 
-import lxml.etree
-import lxml.html
-import requests
 import six
 
+# requests and lxml are relatively expensive to import, and not every user
+# needs them (e.g. when replaying cached pages with a custom scrape_fetch).
+# They are imported on first use instead.
 
-SHARED_SESSION = requests.Session()
-SHARED_SESSION.headers['User-Agent'] = "Mozilla/5.0 (Livescrape)"
+
+class _LazySession(object):
+    """Proxy for a requests session, which is created on first use."""
+
+    def __init__(self):
+        object.__setattr__(self, "_session", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _get_session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+
+                    session = requests.Session()
+                    headers = session.headers
+                    headers['User-Agent'] = "Mozilla/5.0 (Livescrape)"
+                    object.__setattr__(self, "_session", session)
+        return self._session
+
+    def __getattr__(self, name):
+        # Private and special names aren't forwarded. Otherwise, copy and
+        # pickle, which create instances without calling __init__, would
+        # recurse looking for _session.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._get_session(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_session(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._get_session(), name)
+
+    def __repr__(self):
+        return repr(self._get_session())
+
+
+SHARED_SESSION = _LazySession()
+
+
+def _escape(text, quote=True):
+    try:
+        from html import escape
+    except ImportError:  # pragma: no cover
+        from cgi import escape  # python2
+    return escape(text, quote)
+
+
+class ParserBackend(object):
+    """Base class for parser backends.
+
+    A backend turns raw HTML into a document, and knows how to query the
+    elements of that document. A ScrapedPage uses the backend in its
+    `scrape_parser` attribute.
+    """
+
+    @abstractmethod
+    def parse(self, page):  # pragma: no cover
+        """Creates a document from the raw (unicode) HTML."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def select(self, element, selector):  # pragma: no cover
+        """Returns the elements matching a css selector within element."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def text_content(self, element):  # pragma: no cover
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_attribute(self, element, name):  # pragma: no cover
+        raise NotImplementedError()
+
+    @abstractmethod
+    def to_html(self, element, include_tag=True):  # pragma: no cover
+        raise NotImplementedError()
+
+
+class LxmlBackend(ParserBackend):
+    """Parses documents using lxml's HTML parser.
+
+    The parser and the compiled css selectors are created once per thread,
+    and reused for every document. Any additional keyword arguments are
+    passed to `lxml.html.HTMLParser`.
+    """
+
+    def __init__(self, remove_comments=False, remove_scripts=False,
+                 **parser_options):
+        self.remove_comments = remove_comments
+        self.remove_scripts = remove_scripts
+        self.parser_options = parser_options
+        self._local = threading.local()
+
+    def _cached(self, key, factory):
+        # lxml parsers can't be shared between threads, so neither the
+        # parser nor the compiled selectors are.
+        try:
+            cache = self._local.cache
+        except AttributeError:
+            cache = self._local.cache = {}
+
+        try:
+            return cache[key]
+        except KeyError:
+            value = cache[key] = factory()
+            return value
+
+    def _create_parser(self):
+        import lxml.html
+
+        return lxml.html.HTMLParser(remove_comments=self.remove_comments,
+                                    **self.parser_options)
+
+    def _fromstring(self, page, parser):
+        import lxml.html
+
+        return lxml.html.fromstring(page, parser=parser)
+
+    def parse(self, page):
+        doc = self._fromstring(page, self._cached("parser",
+                                                  self._create_parser))
+        if self.remove_scripts:
+            import lxml.etree
+
+            lxml.etree.strip_elements(doc, "script", with_tail=False)
+        return doc
+
+    def _translator(self, element):
+        # Like lxml's cssselect(): only html elements are matched
+        # case-insensitively, e.g. when scrape_create_document returns xml.
+        import lxml.html
+
+        return "html" if isinstance(element, lxml.html.HtmlMixin) else "xml"
+
+    def select(self, element, selector):
+        translator = self._translator(element)
+
+        def compile_selector():
+            import lxml.cssselect
+
+            return lxml.cssselect.CSSSelector(selector, translator=translator)
+
+        return self._cached(("css", translator, selector),
+                            compile_selector)(element)
+
+    def text_content(self, element):
+        def compile_xpath():
+            import lxml.etree
+
+            return lxml.etree.XPath("string()")
+
+        return self._cached("string", compile_xpath)(element)
+
+    def get_attribute(self, element, name):
+        return element.get(name)
+
+    def to_html(self, element, include_tag=True):
+        import lxml.html
+
+        if include_tag:
+            return lxml.html.tostring(element, encoding="unicode")
+
+        value = six.text_type("")
+        if element.text:
+            value = _escape(element.text, quote=False)
+        for child in element:
+            value += lxml.html.tostring(child, encoding="unicode")
+        return value
+
+
+class Html5libBackend(LxmlBackend):
+    """Parses documents like a browser would, using html5lib.
+
+    Slower than LxmlBackend, but more robust on broken markup. The result
+    is an lxml document, so everything else works the same. Requires
+    `html5lib`.
+    """
+
+    def _create_parser(self):
+        import lxml.html.html5parser
+
+        return lxml.html.html5parser.HTMLParser(
+            namespaceHTMLElements=False, **self.parser_options)
+
+    def _translator(self, element):
+        # html5parser produces plain lxml.etree elements, but it's html
+        return "html"
+
+    def _fromstring(self, page, parser):
+        import lxml.etree
+        import lxml.html.html5parser
+
+        doc = lxml.html.html5parser.document_fromstring(page, parser=parser)
+        if self.remove_comments:
+            lxml.etree.strip_elements(doc, lxml.etree.Comment,
+                                      with_tail=False)
+        return doc
+
+
+class SelectolaxBackend(ParserBackend):
+    """Parses documents using selectolax's lexbor engine.
+
+    Usually a lot faster than lxml, and css selectors are evaluated
+    natively. Note that `extract` functions and decorated methods receive
+    selectolax nodes instead of lxml elements. Requires `selectolax`.
+    """
+
+    def __init__(self, remove_comments=False, remove_scripts=False):
+        self.remove_comments = remove_comments
+        self.remove_scripts = remove_scripts
+
+    def parse(self, page):
+        from selectolax.lexbor import LexborHTMLParser
+
+        tree = LexborHTMLParser(page)
+        if self.remove_scripts:
+            tree.strip_tags(["script"])
+        if self.remove_comments:
+            for node in [node for node in tree.root.traverse()
+                         if node.is_comment_node]:
+                node.decompose()
+        return tree.root
+
+    def select(self, element, selector):
+        return element.css(selector)
+
+    def text_content(self, element):
+        return element.text(deep=True)
+
+    def get_attribute(self, element, name):
+        attributes = element.attributes
+        if name not in attributes:
+            return None
+        # Attributes without a value are reported as None
+        return attributes[name] or six.text_type("")
+
+    def to_html(self, element, include_tag=True):
+        if include_tag:
+            return element.html
+        return element.inner_html or six.text_type("")
 
 
 class ScrapedAttribute(object):
@@ -44,9 +288,10 @@ class ScrapedAttribute(object):
         if self._extract:
             value = self._extract(element)
         elif self.attribute is None:
-            value = element.text_content()
+            value = scraped_page.scrape_parser.text_content(element)
         else:
-            value = element.get(self.attribute)
+            value = scraped_page.scrape_parser.get_attribute(element,
+                                                             self.attribute)
             if value is None:
                 return
 
@@ -84,6 +329,7 @@ class _ScrapedMeta(type):
     """
     def __new__(cls, name, bases, namespace):
         keys = []
+        attributes = {}
         for key, value in namespace.items():
             if isinstance(value, ScrapedAttribute):
                 def mk_attribute(selector):
@@ -93,9 +339,11 @@ class _ScrapedMeta(type):
 
                 namespace[key] = mk_attribute(value)
                 keys.append(key)
+                attributes[key] = value
 
         result = super(_ScrapedMeta, cls).__new__(cls, name, bases, namespace)
         result.scrape_keys = keys
+        result._scrape_attributes = attributes
         _SCRAPER_CLASSES[name] = result
         return result
 
@@ -107,6 +355,7 @@ class ScrapedPage(object):
     scrape_args = []
     scrape_arg_defaults = {}
     scrape_headers = {}
+    scrape_parser = LxmlBackend()
 
     def __init__(self, *pargs, **kwargs):
         scrape_url = kwargs.pop("scrape_url", None)
@@ -139,14 +388,16 @@ class ScrapedPage(object):
                                        headers=self.scrape_headers).text
 
     def scrape_create_document(self, page):
-        return lxml.html.fromstring(page)
+        return self.scrape_parser.parse(page)
 
-    def _get_value(self, property_scraper):
+    def _get_document(self):
         if self._scrape_doc is None:
             page = self.scrape_fetch(self.scrape_url)
             self._scrape_doc = self.scrape_create_document(page)
+        return self._scrape_doc
 
-        return property_scraper.get(self._scrape_doc, scraped_page=self)
+    def _get_value(self, property_scraper):
+        return property_scraper.get(self._get_document(), scraped_page=self)
 
     @property
     def _dict(self):
@@ -169,7 +420,7 @@ class Css(ScrapedAttribute):
         if not self.selector:
             return doc
 
-        elements = doc.cssselect(self.selector)
+        elements = scraped_page.scrape_parser.select(doc, self.selector)
 
         if self.multiple:
             values = [self.extract(element, scraped_page)
@@ -222,15 +473,7 @@ class CssRaw(Css):
         super(CssRaw, self).__init__(selector, **kwargs)
 
     def extract(self, element, scraped_page):
-        if self.include_tag:
-            value = lxml.html.tostring(element, encoding="unicode")
-        else:
-            value = six.text_type("")
-            if element.text:
-                value = cgi.escape(element.text)
-            for child in element:
-                value += lxml.html.tostring(child, encoding="unicode")
-
+        value = scraped_page.scrape_parser.to_html(element, self.include_tag)
         return self.perform_cleanups(value, element, scraped_page)
 
 
@@ -243,7 +486,7 @@ class CssMulti(Css):
             "The 'CssMulti' class was deprecated in favor of CssGroup",
             DeprecationWarning)
 
-    def extract(self, element, scraped_page=None):
+    def extract(self, element, scraped_page):
         value = {}
 
         for key, selector in self.subselectors.items():
@@ -288,7 +531,7 @@ class CssGroup(Css):
         super(CssGroup, self).__init__(*pargs, **kwargs)
         self._subselectors = {}
 
-    def extract(self, element, scraped_page=None):
+    def extract(self, element, scraped_page):
         value = CssGroup._CompoundAttribute(self, element, scraped_page)
         return self.perform_cleanups(value, element, scraped_page)
 
@@ -320,3 +563,344 @@ class CssLink(Css):
             referer = self.referer
 
         return factory(scrape_url=url, scrape_referer=referer)
+
+
+def _follow_links(page, next_page):
+    # Stop when a page links back to one we've seen, e.g. a "next" link to
+    # "#" on the last page. Fragments don't result in a different page.
+    visited = set()
+    while page is not None:
+        url = urlparse.urldefrag(page.scrape_url)[0]
+        if url in visited:
+            return
+        visited.add(url)
+        yield page
+        page = getattr(page, next_page)
+
+
+def _prefetch_pages(page, next_page, pages, slots, stop):
+    try:
+        for page in _follow_links(page, next_page):
+            # Claim a slot before fetching, so no more than `lookahead`
+            # pages are read ahead of the consumer.
+            slots.acquire()
+            if stop.is_set():
+                return
+            # Fetch and parse the page in this thread
+            page._get_document()
+            pages.put((page, None))
+        pages.put((None, None))
+    except Exception:
+        pages.put((None, sys.exc_info()))
+
+
+def _prefetched_pages(page, next_page, lookahead):
+    pages = six.moves.queue.Queue()
+    slots = threading.Semaphore(lookahead)
+    stop = threading.Event()
+    worker = threading.Thread(target=_prefetch_pages,
+                              args=(page, next_page, pages, slots, stop))
+    worker.daemon = True
+    worker.start()
+
+    try:
+        while True:
+            (page, exc_info) = pages.get()
+            if exc_info:
+                six.reraise(*exc_info)
+            elif page is None:
+                return
+            slots.release()
+            yield page
+    finally:
+        stop.set()
+        # Wake up the worker if it is waiting for a slot
+        slots.release()
+
+
+def paginate(page, rows=None, next_page="next", lookahead=1):
+    """Iterates over a paginated listing, starting at `page`.
+
+    Follows the `next_page` attribute (typically a CssLink) until it is
+    None or links to a page that was already visited, and yields the items
+    of the `rows` attribute of every page as a single stream. When `rows`
+    is None, the pages themselves are yielded.
+
+    Up to `lookahead` pages are fetched and parsed in a background thread
+    while the current page is being processed. Use `lookahead=0` to fetch
+    pages in the calling thread instead.
+    """
+    if lookahead:
+        pages = _prefetched_pages(page, next_page, lookahead)
+    else:
+        pages = _follow_links(page, next_page)
+
+    try:
+        for page in pages:
+            if rows is None:
+                yield page
+            else:
+                for row in getattr(page, rows) or ():
+                    yield row
+    finally:
+        pages.close()
+
+
+def _is_singular_group(attribute):
+    return isinstance(attribute, CssGroup) and not attribute.multiple
+
+
+def _serialize_value(value, attribute=None):
+    """Converts a scraped value into plain python data.
+
+    Linked pages are replaced by their url, groups by a dictionary. A
+    singular group which wasn't found becomes a dictionary of Nones, so
+    the keys of a record don't depend on the data.
+    """
+    if isinstance(value, ScrapedPage):
+        return value.scrape_url
+    elif isinstance(value, CssGroup._CompoundAttribute):
+        return dict((key, _serialize_value(value[key], subselector))
+                    for (key, subselector) in value._subselectors.items())
+    elif isinstance(value, dict):
+        return dict((key, _serialize_value(item))
+                    for (key, item) in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [_serialize_value(item, attribute) for item in value]
+    elif value is None and _is_singular_group(attribute):
+        return dict((key, _serialize_value(None, subselector))
+                    for (key, subselector)
+                    in attribute._subselectors.items())
+    return value
+
+
+def _flatten(record, prefix, result):
+    for key, value in record.items():
+        if isinstance(value, dict):
+            _flatten(value, prefix + key + ".", result)
+        else:
+            result[prefix + key] = value
+    return result
+
+
+def scrape_record(page):
+    """Returns a flat, serializable record for a ScrapedPage.
+
+    Nested (singular) groups are flattened into dotted keys, e.g.
+    `user.name`. Groups with `multiple=True` become lists of dictionaries,
+    and links are replaced by the url of the linked page.
+    """
+    attributes = page._scrape_attributes
+    values = dict((key, _serialize_value(getattr(page, key),
+                                         attributes.get(key)))
+                  for key in page.scrape_keys)
+    return _flatten(values, "", {})
+
+
+def _record_batches(pages, batch_size):
+    batch = []
+    for page in pages:
+        batch.append(scrape_record(page))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _text_default(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError("%r is not serializable" % (value,))
+
+
+def _csv_value(value):
+    if isinstance(value, list):
+        value = json.dumps(value, default=_text_default)
+    elif isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat()
+
+    # The python2 csv module doesn't support unicode
+    if six.PY2 and isinstance(value, six.text_type):  # pragma: no cover
+        value = value.encode("utf8")
+    return value
+
+
+def export_jsonl(pages, fileobj, batch_size=100):
+    """Writes a JSON record per line for each page in `pages`.
+
+    `pages` may be any iterable (including a generator performing a crawl).
+    Records are written every `batch_size` pages, so memory use does not
+    depend on the number of pages. Returns the number of records written.
+    """
+    count = 0
+    for batch in _record_batches(pages, batch_size):
+        # json.dumps returns bytes on python2
+        fileobj.write(six.text_type("").join(
+            six.text_type(json.dumps(record, default=_text_default,
+                                     sort_keys=True)) + "\n"
+            for record in batch))
+        count += len(batch)
+    return count
+
+
+def export_csv(pages, fileobj, fields=None, batch_size=100):
+    """Writes a CSV row for each page in `pages`.
+
+    The columns are `fields`, or the keys of the first batch when omitted.
+    Keys not among the columns are dropped. Lists are stored as JSON.
+    On python2, `fileobj` should be opened in binary mode, and strings are
+    written utf-8 encoded. Returns the number of records written.
+    """
+    writer = None
+    count = 0
+    for batch in _record_batches(pages, batch_size):
+        if writer is None:
+            if fields is None:
+                fields = sorted(set(key for record in batch
+                                    for key in record))
+            writer = csv.DictWriter(fileobj, fields, extrasaction='ignore')
+            writer.writeheader()
+
+        writer.writerows(
+            dict((key, _csv_value(value)) for (key, value) in record.items())
+            for record in batch)
+        count += len(batch)
+    return count
+
+
+def _arrow_type(pyarrow, attribute):
+    """Returns the arrow type for the values of a scraped attribute."""
+    if isinstance(attribute, (CssGroup, CssMulti)):
+        subselectors = (attribute._subselectors
+                        if isinstance(attribute, CssGroup)
+                        else attribute.subselectors)
+        value_type = pyarrow.struct(
+            [(key, _arrow_type(pyarrow, subselector))
+             for (key, subselector) in sorted(subselectors.items())])
+    elif isinstance(attribute, CssInt):
+        value_type = pyarrow.int64()
+    elif isinstance(attribute, CssFloat):
+        value_type = pyarrow.float64()
+    elif isinstance(attribute, CssDate):
+        value_type = pyarrow.timestamp(
+            "us", tz="UTC" if attribute.tzinfo else None)
+    elif isinstance(attribute, CssBoolean):
+        value_type = pyarrow.bool_()
+    else:
+        value_type = pyarrow.string()
+
+    if attribute.multiple:
+        return pyarrow.list_(value_type)
+    return value_type
+
+
+def _arrow_types(pyarrow, attributes, prefix=""):
+    # Mirrors scrape_record, which flattens singular groups
+    result = {}
+    for key, attribute in attributes.items():
+        if _is_singular_group(attribute):
+            result.update(_arrow_types(pyarrow, attribute._subselectors,
+                                       prefix + key + "."))
+        else:
+            result[prefix + key] = _arrow_type(pyarrow, attribute)
+    return result
+
+
+def _fill_null_type(pyarrow, inferred, declared=None):
+    """Replaces the null types in an inferred type.
+
+    Arrow infers the null type for values which are all None. Those are
+    replaced by the declared type, or by string if there is none.
+    """
+    types = pyarrow.types
+    if types.is_null(inferred):
+        return pyarrow.string() if declared is None else declared
+    elif types.is_list(inferred):
+        if declared is None or not types.is_list(declared):
+            declared = None
+        else:
+            declared = declared.value_type
+        return pyarrow.list_(
+            _fill_null_type(pyarrow, inferred.value_type, declared))
+    elif types.is_struct(inferred):
+        if declared is None or not types.is_struct(declared):
+            declared = {}
+        else:
+            declared = dict((field.name, field.type) for field in declared)
+        return pyarrow.struct(
+            [(field.name,
+              _fill_null_type(pyarrow, field.type, declared.get(field.name)))
+             for field in inferred])
+    return inferred
+
+
+def _infer_schema(pyarrow, page, batch):
+    declared = _arrow_types(pyarrow, page._scrape_attributes)
+    inferred = pyarrow.Table.from_pylist(batch).schema
+    return pyarrow.schema(
+        [(field.name,
+          _fill_null_type(pyarrow, field.type, declared.get(field.name)))
+         for field in inferred])
+
+
+def _export_arrow(pages, batch_size, schema, open_writer):
+    import pyarrow
+
+    pages = iter(pages)
+    first_page = next(pages, None)
+    if first_page is None:
+        return 0
+    pages = itertools.chain([first_page], pages)
+
+    infer_schema = schema is None
+    writer = None
+    count = 0
+    try:
+        for batch in _record_batches(pages, batch_size):
+            if schema is None:
+                schema = _infer_schema(pyarrow, first_page, batch)
+            elif infer_schema:
+                unknown = set(key for record in batch
+                              for key in record) - set(schema.names)
+                if unknown:
+                    raise ValueError(
+                        "Keys %s were not in the inferred schema, pass a "
+                        "schema explicitly" % ", ".join(sorted(unknown)))
+
+            table = pyarrow.Table.from_pylist(batch, schema=schema)
+            if writer is None:
+                writer = open_writer(schema)
+            writer.write_table(table)
+            count += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def export_parquet(pages, where, batch_size=1000, schema=None):
+    """Writes the records for `pages` to a Parquet file.
+
+    Requires `pyarrow`. Unless a `schema` is passed, it is inferred from the
+    first batch, using the declared attribute types for columns which are
+    all None. Every batch is written as a row group. Returns the number of
+    records written.
+    """
+    import pyarrow.parquet
+
+    return _export_arrow(
+        pages, batch_size, schema,
+        lambda schema: pyarrow.parquet.ParquetWriter(where, schema))
+
+
+def export_arrow(pages, where, batch_size=1000, schema=None):
+    """Writes the records for `pages` to an Arrow IPC (feather v2) file.
+
+    Requires `pyarrow`. Behaves like `export_parquet` otherwise.
+    """
+    import pyarrow.ipc
+
+    return _export_arrow(
+        pages, batch_size, schema,
+        lambda schema: pyarrow.ipc.new_file(where, schema))
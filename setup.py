@@ -9,6 +9,9 @@ setup(
     author_email='koert@ondergetekende.nl',
     py_modules=["livescrape"],
     install_requires=["lxml", "requests", "cssselect", "six"],
+    extras_require={"arrow": ["pyarrow"],
+                    "html5lib": ["html5lib"],
+                    "selectolax": ["selectolax"]},
     classifiers=[
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
@@ -1,7 +1,18 @@
+import copy
 import datetime
+import io
+import itertools
+import json
+import os
 import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 
 import responses
+import six
 import unittest2 as unittest
 
 import livescrape
@@ -11,6 +22,19 @@ class BasePage(livescrape.ScrapedPage):
     scrape_url = "http://fake-host/test.html"
 
 
+def _csv_file():
+    # The python2 csv module writes bytes
+    return io.BytesIO() if six.PY2 else io.StringIO()
+
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
 class Test(unittest.TestCase):
     def setUp(self):
         responses.reset()
@@ -199,6 +223,90 @@ class Test(unittest.TestCase):
         with self.assertRaises(AttributeError):
             x.foo[0].nonexistent
 
+    def test_lazy_imports(self):
+        # Importing livescrape shouldn't import requests or lxml, and
+        # shouldn't create the shared session
+        output = subprocess.check_output(
+            [sys.executable, "-c",
+             "import sys, livescrape; "
+             "print(sorted(m for m in ('requests', 'lxml') "
+             "if m in sys.modules))"],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.decode("ascii").strip(), "[]")
+
+    def test_shared_session(self):
+        session = livescrape.SHARED_SESSION
+        self.assertIs(livescrape.SHARED_SESSION, session)
+        self.assertIs(BasePage().scrape_session, session)
+        self.assertEqual(session.headers['User-Agent'],
+                         "Mozilla/5.0 (Livescrape)")
+
+        copied = copy.copy(session)
+        self.assertEqual(copied.headers['User-Agent'],
+                         "Mozilla/5.0 (Livescrape)")
+
+    def _export_pages(self):
+        nested = livescrape.CssGroup("i")
+        nested.value = livescrape.Css("span")
+
+        class Page(BasePage):
+            foo = livescrape.Css("h1.foo")
+            date = livescrape.CssDate(".date", '%Y-%m-%d')
+            link = livescrape.CssLink("a", "Page")
+            group = livescrape.CssGroup("table")
+            group.key = livescrape.Css("th")
+            rows = livescrape.CssGroup("table tr", multiple=True)
+            rows.key = livescrape.Css("th")
+            missing = livescrape.CssGroup(".not-there")
+            missing.name = livescrape.Css("b")
+            missing.nested = nested
+
+        return (Page() for _ in range(3))
+
+    def test_scrape_record(self):
+        record = livescrape.scrape_record(next(self._export_pages()))
+
+        self.assertEqual(record, {
+            "foo": "Heading",
+            "date": datetime.datetime(2016, 4, 23),
+            "link": "http://fake-host/very-fake",
+            "group.key": "key",
+            "rows": [{"key": "key"}, {"key": "key2"}],
+            "missing.name": None,
+            "missing.nested.value": None,
+        })
+
+    def test_export_jsonl(self):
+        out = io.StringIO()
+        count = livescrape.export_jsonl(self._export_pages(), out,
+                                        batch_size=2)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(count, 3)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[2])["date"], "2016-04-23T00:00:00")
+        self.assertEqual(json.loads(lines[2])["rows"][1], {"key": "key2"})
+
+    def test_export_csv(self):
+        out = _csv_file()
+        count = livescrape.export_csv(self._export_pages(), out,
+                                      fields=["foo", "rows", "group.key"])
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(count, 3)
+        self.assertEqual(lines[0], "foo,rows,group.key")
+        self.assertEqual(
+            lines[1],
+            'Heading,"[{""key"": ""key""}, {""key"": ""key2""}]",key')
+
+    def test_export_csv_fields(self):
+        out = _csv_file()
+        livescrape.export_csv(self._export_pages(), out)
+
+        self.assertEqual(out.getvalue().splitlines()[0],
+                         "date,foo,group.key,link,missing.name,"
+                         "missing.nested.value,rows")
+
     def test_cleanup(self):
         cleanup_args = [None]
 
@@ -353,5 +461,342 @@ class Test(unittest.TestCase):
         self.assertEqual(len(responses.calls), 2)
         self.assertNotIn("Referer", responses.calls[1].request.headers)
 
+
+class PaginateTest(unittest.TestCase):
+    def _add_pages(self, count):
+        responses.reset()
+        for page in range(1, count + 1):
+            responses.add(
+                responses.GET, "http://fake-host/page/%d" % page,
+                """<html><body>
+                <ul><li>%d.1</li><li>%d.2</li></ul>
+                %s
+                </body></html>
+                """ % (page, page,
+                       '<a class="next" href="/page/%d">next</a>' % (page + 1)
+                       if page < count else ''))
+
+    def _wait_for_calls(self, count):
+        # Give the background thread the chance to fetch ahead, then some
+        # more time to fetch too much.
+        for _ in range(100):
+            if len(responses.calls) >= count:
+                break
+            time.sleep(0.01)
+        time.sleep(0.1)
+
+    def setUp(self):
+        self._add_pages(3)
+        responses.start()
+        self.addCleanup(responses.stop)
+
+        class ListingPage(livescrape.ScrapedPage):
+            scrape_url = "http://fake-host/page/1"
+            next = livescrape.CssLink("a.next", "ListingPage")
+            items = livescrape.Css("li", multiple=True)
+
+        self.page_class = ListingPage
+
+    def test_paginate(self):
+        for lookahead in (0, 1, 2):
+            rows = livescrape.paginate(self.page_class(), "items",
+                                       lookahead=lookahead)
+
+            self.assertEqual(list(rows), ["1.1", "1.2", "2.1", "2.2",
+                                          "3.1", "3.2"])
+
+    def test_paginate_pages(self):
+        pages = livescrape.paginate(self.page_class(), next_page="next")
+
+        self.assertEqual([page.scrape_url for page in pages],
+                         ["http://fake-host/page/1",
+                          "http://fake-host/page/2",
+                          "http://fake-host/page/3"])
+
+    def test_paginate_prefetch(self):
+        rows = livescrape.paginate(self.page_class(), "items", lookahead=2)
+
+        self.assertEqual(next(rows), "1.1")
+        self._wait_for_calls(3)
+
+        self.assertEqual(len(responses.calls), 3)
+        rows.close()
+
+    def test_paginate_lookahead(self):
+        self._add_pages(10)
+
+        for lookahead in (1, 2, 3):
+            responses.calls.reset()
+            rows = livescrape.paginate(self.page_class(), "items",
+                                       lookahead=lookahead)
+
+            # While processing page 1, only `lookahead` pages are read ahead
+            self.assertEqual(next(rows), "1.1")
+            self._wait_for_calls(1 + lookahead)
+            self.assertEqual(len(responses.calls), 1 + lookahead)
+
+            # Moving on to page 2 frees up a slot for one more page
+            self.assertEqual([next(rows) for _ in range(2)], ["1.2", "2.1"])
+            self._wait_for_calls(2 + lookahead)
+            self.assertEqual(len(responses.calls), 2 + lookahead)
+
+            rows.close()
+
+    def test_paginate_cycle(self):
+        for (page, href) in ((3, "#"), (3, "/page/3"), (2, "/page/1")):
+            responses.replace(
+                responses.GET, "http://fake-host/page/%d" % page,
+                body='<li>last</li><a class="next" href="%s">next</a>' % href)
+
+            for lookahead in (0, 1):
+                pages = livescrape.paginate(self.page_class(),
+                                            lookahead=lookahead)
+
+                self.assertEqual(len(list(itertools.islice(pages, 5))), page)
+
+    def test_paginate_error(self):
+        responses.replace(responses.GET, "http://fake-host/page/2",
+                          body=ValueError("Connection failed"))
+        rows = livescrape.paginate(self.page_class(), "items")
+
+        self.assertEqual(next(rows), "1.1")
+        self.assertEqual(next(rows), "1.2")
+        with self.assertRaises(ValueError):
+            next(rows)
+
+
+@unittest.skipUnless(_importable("pyarrow"), "pyarrow is not installed")
+class ArrowExportTest(unittest.TestCase):
+    def setUp(self):
+        responses.reset()
+        for page in range(5):
+            # The first pages lack a usable number, tags and user, so their
+            # types can't be inferred from the first batch
+            responses.add(
+                responses.GET, "http://fake-host/page/%d" % page,
+                """<html><body>
+                <h1>Page %d</h1>
+                <span class=int>%s</span>
+                %s
+                </body></html>
+                """ % (page, page if page >= 2 else "n/a",
+                       '<ul><li>a</li><li>b</li></ul>'
+                       '<p class=user><b>bob</b></p>'
+                       '<span class=float>1.5</span>'
+                       '<span class=date>2016-04-23</span>'
+                       '<span class=bool></span>' if page >= 2 else ''))
+        responses.start()
+        self.addCleanup(responses.stop)
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        class Page(livescrape.ScrapedPage):
+            name = livescrape.Css("h1")
+            number = livescrape.CssInt(".int")
+            tags = livescrape.Css("li", multiple=True)
+            user = livescrape.CssGroup(".user")
+            user.name = livescrape.Css("b")
+
+        class TypedPage(Page):
+            number = livescrape.CssInt(".int")
+            price = livescrape.CssFloat(".float")
+            date = livescrape.CssDate(".date", '%Y-%m-%d')
+            flag = livescrape.CssBoolean(".bool")
+            rows = livescrape.CssGroup("li", multiple=True)
+            rows.bold = livescrape.Css("b")
+
+        self.page_class = Page
+        self.typed_page_class = TypedPage
+
+    def _pages(self, page_class=None):
+        return ((page_class or self.page_class)(
+            scrape_url="http://fake-host/page/%d" % page)
+            for page in range(5))
+
+    def _check_table(self, table):
+        import pyarrow
+
+        self.assertEqual(table.schema.field("number").type, pyarrow.int64())
+        self.assertEqual(table.column("number").to_pylist(),
+                         [None, None, 2, 3, 4])
+        self.assertEqual(table.column("tags").to_pylist(),
+                         [[], [], ["a", "b"], ["a", "b"], ["a", "b"]])
+        self.assertEqual(table.column("user.name").to_pylist(),
+                         [None, None, "bob", "bob", "bob"])
+
+    def test_export_parquet(self):
+        import pyarrow.parquet
+
+        filename = os.path.join(self.directory, "pages.parquet")
+        count = livescrape.export_parquet(self._pages(), filename,
+                                          batch_size=2)
+
+        self.assertEqual(count, 5)
+        self.assertEqual(pyarrow.parquet.ParquetFile(filename)
+                         .metadata.num_row_groups, 3)
+        self._check_table(pyarrow.parquet.read_table(filename))
+
+    def test_export_arrow(self):
+        import pyarrow.ipc
+
+        filename = os.path.join(self.directory, "pages.arrow")
+        count = livescrape.export_arrow(self._pages(), filename,
+                                        batch_size=2)
+
+        self.assertEqual(count, 5)
+        self._check_table(pyarrow.ipc.open_file(filename).read_all())
+
+    def test_export_types(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        filename = os.path.join(self.directory, "pages.parquet")
+        livescrape.export_parquet(self._pages(self.typed_page_class),
+                                  filename, batch_size=2)
+
+        table = pyarrow.parquet.read_table(filename)
+        types = dict((field.name, field.type) for field in table.schema)
+        self.assertEqual(types, {
+            "number": pyarrow.int64(),
+            "price": pyarrow.float64(),
+            "date": pyarrow.timestamp("us"),
+            "flag": pyarrow.bool_(),
+            "rows": pyarrow.list_(pyarrow.struct([("bold",
+                                                   pyarrow.string())])),
+        })
+        self.assertEqual(table.column("price").to_pylist()[2], 1.5)
+        self.assertEqual(table.column("flag").to_pylist(),
+                         [None, None, True, True, True])
+        self.assertEqual(table.column("rows").to_pylist()[2],
+                         [{"bold": None}, {"bold": None}])
+
+    def test_export_nothing(self):
+        filename = os.path.join(self.directory, "pages.parquet")
+
+        self.assertEqual(livescrape.export_parquet([], filename), 0)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_export_schema(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        filename = os.path.join(self.directory, "pages.parquet")
+        schema = pyarrow.schema([("name", pyarrow.string())])
+        livescrape.export_parquet(self._pages(), filename, batch_size=2,
+                                  schema=schema)
+
+        table = pyarrow.parquet.read_table(filename)
+        self.assertEqual(table.column_names, ["name"])
+        self.assertEqual(table.column("name").to_pylist()[4], "Page 4")
+
+    def test_export_unknown_keys(self):
+        class OtherPage(self.page_class):
+            other = livescrape.Css("h1")
+
+        pages = itertools.chain(self._pages(), self._pages(OtherPage))
+        with self.assertRaises(ValueError):
+            livescrape.export_parquet(
+                pages, os.path.join(self.directory, "pages.parquet"),
+                batch_size=5)
+
+
+class BackendTestMixin(object):
+    def setUp(self):
+        responses.reset()
+        responses.add(
+            responses.GET, BasePage.scrape_url,
+            """<html><body>
+            <!-- comment -->
+            <h1 class="foo" data-foo=1>Heading</h1>
+            <script>var x = 1;</script>
+            <ul>
+              <li><a href="/one">One</a> <b>first</b></li>
+              <li><a href="/two">Two</a></li>
+            </ul>
+            </body></html>
+            """)
+        responses.start()
+        self.addCleanup(responses.stop)
+
+    def _page(self, **options):
+        class Page(BasePage):
+            scrape_parser = self.backend(**options)
+            foo = livescrape.Css("h1.foo")
+            data_foo = livescrape.Css("h1", attribute="data-foo")
+            not_there = livescrape.Css("h1", attribute="not-there")
+            items = livescrape.CssGroup("ul li", multiple=True)
+            items.link = livescrape.CssLink("a", "Page")
+            items.title = livescrape.Css("a")
+            body = livescrape.CssRaw("body")
+            first_item = livescrape.CssRaw("li b", include_tag=True)
+            first_link = livescrape.CssRaw("li")
+
+        return Page()
+
+    def test_scrape(self):
+        x = self._page()
+
+        self.assertEqual(x.foo, "Heading")
+        self.assertEqual(x.data_foo, "1")
+        self.assertIsNone(x.not_there)
+        self.assertEqual([item.title for item in x.items], ["One", "Two"])
+        self.assertEqual(x.items[1].link.scrape_url, "http://fake-host/two")
+        self.assertEqual(x.first_item, "<b>first</b>")
+        self.assertEqual(x.first_link, '<a href="/one">One</a> <b>first</b>')
+        self.assertIn("<!-- comment -->", x.body)
+        self.assertIn("var x = 1;", x.body)
+
+    def test_strip(self):
+        x = self._page(remove_comments=True, remove_scripts=True)
+
+        self.assertEqual(x.foo, "Heading")
+        self.assertNotIn("comment", x.body)
+        self.assertNotIn("var x", x.body)
+
+
+class LxmlBackendTest(BackendTestMixin, unittest.TestCase):
+    backend = livescrape.LxmlBackend
+
+    def test_reuse_parser(self):
+        x = self._page()
+        x.foo
+        parser = x.scrape_parser._local.cache["parser"]
+
+        self._page().foo
+        self.assertIs(x.scrape_parser._local.cache["parser"], parser)
+
+    def test_xml_document(self):
+        class Page(BasePage):
+            ids = livescrape.Css("Item", attribute="id", multiple=True)
+            lowercase = livescrape.Css("item", multiple=True)
+
+            def scrape_fetch(self, url):
+                return ('<Feed><Item id="1">One</Item>'
+                        '<Item id="2">Two</Item></Feed>')
+
+            def scrape_create_document(self, page):
+                import lxml.etree
+
+                return lxml.etree.fromstring(page)
+
+        x = Page()
+
+        # xml is case sensitive, unlike html
+        self.assertEqual(x.ids, ["1", "2"])
+        self.assertEqual(x.lowercase, [])
+
+
+@unittest.skipUnless(_importable("html5lib"), "html5lib is not installed")
+class Html5libBackendTest(LxmlBackendTest):
+    backend = livescrape.Html5libBackend
+
+
+@unittest.skipUnless(_importable("selectolax"),
+                     "selectolax is not installed")
+class SelectolaxBackendTest(BackendTestMixin, unittest.TestCase):
+    backend = livescrape.SelectolaxBackend
+
+
 if __name__ == '__main__':
     unittest.main()